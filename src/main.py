@@ -1,13 +1,12 @@
 import pandas as pd
 import geopandas as gpd
-from shapely.geometry import Point
-from shapely.geometry import Polygon
+import shapely
+from rasterio.features import rasterize
+from rasterio.transform import from_bounds
 import numpy as np
-import folium
-from folium.plugins import HeatMap
+from numba import guvectorize, njit, prange
 import os
-import io
-import boto3
+import hashlib
 
 
 # This program takes a CSV file with latitude and longitude coordinates as input,
@@ -16,6 +15,14 @@ import boto3
 # Heatmap is an HTML file that can be opened in a web browser.
 # Last updated on July 28th, 2025
 
+# Number of consecutive ring edges grouped under one bounding box by boundary_rings
+EDGE_BLOCK_SIZE = 32
+
+# Cell values of the rasterized boundary grid
+GRID_OUTSIDE = 0
+GRID_INSIDE = 1
+GRID_EDGE = 2
+
 def create_continental_us_boundary(shapefile_path):
     
     # Loads a US nation shapefile and returns a polygon for the continental US
@@ -35,106 +42,344 @@ def create_continental_us_boundary(shapefile_path):
     print("Boundary for continental US created by isolating the largest polygon.")
     return largest_polygon
 
-def fast_jitter_with_boundary(df, lat_col, lon_col, offset_meters, boundary):
+@guvectorize(
+    ['void(f8, f8, f8, f8, f8, f8, f8[:], f8[:])'],
+    '(),(),(),(),(),()->(),()',
+    target='parallel',
+    fastmath=True,
+    cache=True
+)
+def _jitter_ufunc(lat, lon, cos_lat, u1, u2, offset_meters, out_lat, out_lon):
+    
+    # Offsets a coordinate by a random distance (up to offset_meters) and angle. Compiled as a
+    # parallel ufunc, so calling it on whole arrays runs in one pass with the trig vectorized.
+    # cos_lat is cos(lat), computed once by the caller. u1 and u2 are uniform [0, 1) draws for
+    # the distance and angle. out_lat and out_lon are written in place.
+    earth_radius = 6378137.0
+    rad_to_deg = 180.0 / np.pi
+    distance = np.sqrt(u1) * offset_meters
+    angle = 2.0 * np.pi * u2
+    out_lat[0] = lat + distance * np.sin(angle) / earth_radius * rad_to_deg
+    out_lon[0] = lon + distance * np.cos(angle) / (earth_radius * cos_lat) * rad_to_deg
+
+def boundary_rings(boundary):
+    
+    # Flattens every ring (exteriors and holes) of a Polygon or MultiPolygon into the
+    # coordinate arrays used by the PNPoly test. ring_offsets[r]:ring_offsets[r + 1] selects
+    # the vertices of ring r; the closing vertex of each ring is dropped. Edge k runs from the
+    # previous vertex of its ring (wrapping around) to vertex k. ring_bounds[r] is ring r's
+    # (min x, min y, max x, max y). Each ring's edges are also split into blocks of
+    # EDGE_BLOCK_SIZE: blocks block_offsets[r]:block_offsets[r + 1] belong to ring r, and
+    # block_bounds holds the bounds of each block's edges. The bounds let the PNPoly and
+    # edge-distance kernels skip rings and blocks far from a point.
+    polygons = getattr(boundary, 'geoms', [boundary])
+    rings = []
+    for polygon in polygons:
+        rings.append(np.asarray(polygon.exterior.coords)[:-1, :2])
+        rings.extend(np.asarray(interior.coords)[:-1, :2] for interior in polygon.interiors)
+
+    ring_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    ring_offsets[1:] = np.cumsum([len(ring) for ring in rings])
+    ring_bounds = np.array([[*ring.min(axis=0), *ring.max(axis=0)] for ring in rings])
+
+    block_counts = [-(-len(ring) // EDGE_BLOCK_SIZE) for ring in rings]
+    block_offsets = np.zeros(len(rings) + 1, dtype=np.int64)
+    block_offsets[1:] = np.cumsum(block_counts)
+    block_bounds = []
+    for ring in rings:
+        for first in range(0, len(ring), EDGE_BLOCK_SIZE):
+            # Include the previous vertex so the block's first edge is covered too
+            edge_vertices = ring[np.arange(first - 1, min(first + EDGE_BLOCK_SIZE, len(ring)))]
+            block_bounds.append([*edge_vertices.min(axis=0), *edge_vertices.max(axis=0)])
+
+    coords = np.concatenate(rings)
+    return (
+        np.ascontiguousarray(coords[:, 0]),
+        np.ascontiguousarray(coords[:, 1]),
+        ring_offsets,
+        ring_bounds,
+        block_offsets,
+        np.array(block_bounds)
+    )
+
+@njit(cache=True)
+def _pnpoly_point(x, y, ring_x, ring_y, ring_offsets, ring_bounds, block_offsets, block_bounds):
+    
+    # PNPoly ray-casting test for a single point against the rings from boundary_rings.
+    # Every edge crossing flips the result, so holes and separate parts of a MultiPolygon
+    # are handled by testing all rings together (even-odd rule). A point outside a ring's
+    # bounding box crosses it an even number of times, so that ring is skipped, and the ray
+    # (towards +x) can't cross a block of edges that doesn't span y or lies entirely left of x.
+    crossings = False
+    for r in range(ring_offsets.shape[0] - 1):
+        # Written so NaN coordinates skip every ring
+        if not (ring_bounds[r, 0] <= x <= ring_bounds[r, 2] and ring_bounds[r, 1] <= y <= ring_bounds[r, 3]):
+            continue
+        start = ring_offsets[r]
+        end = ring_offsets[r + 1]
+        for b in range(block_offsets[r], block_offsets[r + 1]):
+            if not (block_bounds[b, 1] <= y <= block_bounds[b, 3] and x <= block_bounds[b, 2]):
+                continue
+            first = start + (b - block_offsets[r]) * EDGE_BLOCK_SIZE
+            j = first - 1 if first > start else end - 1
+            for k in range(first, min(first + EDGE_BLOCK_SIZE, end)):
+                if ((ring_y[k] > y) != (ring_y[j] > y)) and \
+                        (x < (ring_x[j] - ring_x[k]) * (y - ring_y[k]) / (ring_y[j] - ring_y[k]) + ring_x[k]):
+                    crossings = not crossings
+                j = k
+    return crossings
+
+def rasterize_boundary(boundary, grid_bounds, cell_degrees):
+    
+    # Rasterizes the boundary onto a lat/lon grid over grid_bounds (west, south, east, north)
+    # so most points can be classified with a single array lookup. Each cell is GRID_OUTSIDE,
+    # GRID_INSIDE, or GRID_EDGE if the boundary line passes through it. Returns the grid with
+    # the west edge, north edge and cell size needed to index it (see boundary_mask).
+    west, south, east, north = grid_bounds
+    height = int(round((north - south) / cell_degrees))
+    width = int(round((east - west) / cell_degrees))
+    transform = from_bounds(west, south, east, north, width, height)
+
+    # Cells whose center is inside the boundary
+    grid = rasterize([(boundary, GRID_INSIDE)], out_shape=(height, width), transform=transform,
+                     fill=GRID_OUTSIDE, dtype='uint8')
+
+    # Cells touched by the boundary line, padded by one cell so rounding in the line
+    # rasterizer can't leave a crossed cell unmarked
+    edges = rasterize([(boundary.boundary, 1)], out_shape=(height, width), transform=transform,
+                      fill=0, all_touched=True, dtype='uint8').astype(bool)
+    padded_edges = edges.copy()
+    padded_edges[1:, :] |= edges[:-1, :]
+    padded_edges[:-1, :] |= edges[1:, :]
+    padded_edges[:, 1:] |= edges[:, :-1]
+    padded_edges[:, :-1] |= edges[:, 1:]
+    grid[padded_edges] = GRID_EDGE
+
+    print(f"Boundary rasterized to a {width}x{height} grid.")
+    return grid, west, north, cell_degrees
+
+@njit(parallel=True, cache=True)
+def boundary_mask(lons, lats, grid, grid_west, grid_north, cell_degrees,
+                  ring_x, ring_y, ring_offsets, ring_bounds, block_offsets, block_bounds):
+    
+    # Returns a boolean mask of the points inside the boundary. Points in a fully inside or
+    # outside grid cell are answered by the grid lookup; points in edge cells or outside the
+    # grid fall back to the exact PNPoly test, so the result is the same as testing every point.
+    inside = np.zeros(lons.shape[0], dtype=np.bool_)
+    for i in prange(lons.shape[0]):
+        col = (lons[i] - grid_west) / cell_degrees
+        row = (grid_north - lats[i]) / cell_degrees
+        # NaN coordinates fail these comparisons and go to the PNPoly test, which rejects them
+        if 0 <= row < grid.shape[0] and 0 <= col < grid.shape[1]:
+            cell = grid[int(row), int(col)]
+            if cell != GRID_EDGE:
+                inside[i] = cell == GRID_INSIDE
+                continue
+        inside[i] = _pnpoly_point(
+            lons[i], lats[i], ring_x, ring_y, ring_offsets, ring_bounds, block_offsets, block_bounds
+        )
+    return inside
+
+@njit(cache=True)
+def _edge_distance(x, y, ring_x, ring_y, ring_offsets, ring_bounds, block_offsets, block_bounds):
+    
+    # Planar distance (in degrees) from a point to the nearest edge of the rings from boundary_rings.
+    # Rings and edge blocks whose bounding box is farther away than the best distance so far are skipped.
+    best = np.inf
+    for r in range(ring_offsets.shape[0] - 1):
+        if _box_distance_sq(x, y, ring_bounds[r]) >= best:
+            continue
+        start = ring_offsets[r]
+        end = ring_offsets[r + 1]
+        for b in range(block_offsets[r], block_offsets[r + 1]):
+            if _box_distance_sq(x, y, block_bounds[b]) >= best:
+                continue
+            first = start + (b - block_offsets[r]) * EDGE_BLOCK_SIZE
+            j = first - 1 if first > start else end - 1
+            for k in range(first, min(first + EDGE_BLOCK_SIZE, end)):
+                dx = ring_x[k] - ring_x[j]
+                dy = ring_y[k] - ring_y[j]
+                length_sq = dx * dx + dy * dy
+                t = 0.0
+                if length_sq > 0:
+                    t = min(max(((x - ring_x[j]) * dx + (y - ring_y[j]) * dy) / length_sq, 0.0), 1.0)
+                px = ring_x[j] + t * dx - x
+                py = ring_y[j] + t * dy - y
+                best = min(best, px * px + py * py)
+                j = k
+    return np.sqrt(best)
+
+@njit(cache=True)
+def _box_distance_sq(x, y, bounds):
+    
+    # Squared planar distance from a point to a (min x, min y, max x, max y) box; 0 inside it.
+    box_dx = max(bounds[0] - x, 0.0, x - bounds[2])
+    box_dy = max(bounds[1] - y, 0.0, y - bounds[3])
+    return box_dx * box_dx + box_dy * box_dy
+
+@njit(parallel=True, cache=True)
+def _bounded_jitter_kernel(lat, lon, cos_lat, u1, u2, offset_meters,
+                           ring_x, ring_y, ring_offsets, ring_bounds, block_offsets, block_bounds, out_lat, out_lon):
+    
+    # Same offset as _jitter_ufunc, but each point's distance is capped so it can't cross the
+    # nearest boundary edge. Longitude offsets stretch by 1 / cos(lat) in degrees, so the cap
+    # is scaled down by cos(lat); the 0.999 factor keeps points off the edge itself.
+    # This trades anonymity for a guaranteed fit: a point's offset is at most its distance to
+    # the edge, so points on the edge barely move. Points at least offset_meters from the edge
+    # keep the full radius. The boundary margin puts the edge at least ~1.8km past the real
+    # coastline and borders, so only points in the margin band itself can get a smaller offset.
+    earth_radius = 6378137.0
+    rad_to_deg = 180.0 / np.pi
+    for i in prange(lat.shape[0]):
+        edge_distance_m = _edge_distance(
+            lon[i], lat[i], ring_x, ring_y, ring_offsets, ring_bounds, block_offsets, block_bounds
+        ) / rad_to_deg * earth_radius
+        distance = np.sqrt(u1[i]) * min(offset_meters, 0.999 * edge_distance_m * cos_lat[i])
+        angle = 2.0 * np.pi * u2[i]
+        out_lat[i] = lat[i] + distance * np.sin(angle) / earth_radius * rad_to_deg
+        out_lon[i] = lon[i] + distance * np.cos(angle) / (earth_radius * cos_lat[i]) * rad_to_deg
+
+def fast_jitter_with_boundary(df, lat_col, lon_col, offset_meters, rings, grid, rng=None):
     
     # Applies a random offset to coordinates using a fast, vectorized approach.
+    # rings and grid are the outputs of boundary_rings and rasterize_boundary for the
+    # boundary, built once by the caller. rng is a numpy Generator; pass a seeded one for
+    # reproducible output, otherwise a fresh default_rng() is used.
     
     print(f"Starting fast, vectorized jittering for {len(df)} records...")
+    if rng is None:
+        rng = np.random.default_rng()
     
-    # Jitter ALL points at once (vectorized)
-    earth_radius = 6378137
-    random_distances = np.sqrt(np.random.uniform(0, 1, size=len(df))) * offset_meters
-    random_angles = np.random.uniform(0, 2 * np.pi, size=len(df))
-
-    lat_offset_m = random_distances * np.sin(random_angles)
-    lon_offset_m = random_distances * np.cos(random_angles)
-
-    lat_offset_deg = lat_offset_m / earth_radius * (180 / np.pi)
-    lon_offset_deg = lon_offset_m / (earth_radius * np.cos(np.radians(df[lat_col]))) * (180 / np.pi)
-
-    # Create a new DataFrame with jittered points
-    jittered_df = pd.DataFrame({
-        'lat_jittered': df[lat_col] + lat_offset_deg,
-        'lon_jittered': df[lon_col] + lon_offset_deg,
-        'original_index': df.index # Keep track of original position
-    })
-    
-    # Convert to a GeoDataFrame to perform a single, fast spatial check
-    gdf_jittered = gpd.GeoDataFrame(
-        jittered_df, 
-        geometry=gpd.points_from_xy(jittered_df.lon_jittered, jittered_df.lat_jittered),
-        crs="EPSG:4326" # Standard lat/lon CRS
+    # Jitter ALL points at once in a single fused pass
+    lat = df[lat_col].to_numpy(dtype=float)
+    lon = df[lon_col].to_numpy(dtype=float)
+    cos_lat = np.cos(np.deg2rad(lat)) # Shared by the fast pass and the fallback
+    jittered_lat = np.empty_like(lat)
+    jittered_lon = np.empty_like(lon)
+    _jitter_ufunc(
+        lat,
+        lon,
+        cos_lat,
+        rng.random(len(df)),
+        rng.random(len(df)),
+        offset_meters,
+        jittered_lat,
+        jittered_lon
     )
-    
-    boundary_gdf = gpd.GeoDataFrame([{'geometry': boundary}], crs="EPSG:4326")
 
-    # Use a spatial join to find all points inside the boundary at once
-    valid_points = gpd.sjoin(gdf_jittered, boundary_gdf, how="inner", predicate="within")
+    # Check all jittered points against the boundary at once
+    valid_mask = boundary_mask(jittered_lon, jittered_lat, *grid, *rings)
     
-    # Identify the small number of invalid points that need to be fixed
-    invalid_indices = jittered_df[~jittered_df['original_index'].isin(valid_points['original_index'])].original_index
+    # Identify the small number of invalid points that need to be fixed (positions within df)
+    invalid_positions = np.flatnonzero(~valid_mask)
     
-    if not invalid_indices.empty:
-        print(f"Found {len(invalid_indices)} points outside the boundary. Re-processing them...")
-        # Fall back to the slower, iterative method ONLY for these few points
-        fixed_points_df = jitter_coordinates_with_boundary(df.loc[invalid_indices], lat_col, lon_col, offset_meters, boundary)
-        
-        # Combine the initially valid points with the newly fixed ones
-        final_df = pd.concat([
-            valid_points[['lat_jittered', 'lon_jittered']],
-            fixed_points_df
-        ], ignore_index=True)
+    if invalid_positions.size > 0:
+        print(f"Found {len(invalid_positions)} points outside the boundary. Re-processing them...")
+        # Fall back to the retry-then-cap method ONLY for these few points, writing them back in place
+        jittered_lat[invalid_positions], jittered_lon[invalid_positions] = jitter_coordinates_with_boundary(
+            df.iloc[invalid_positions], lat_col, lon_col, offset_meters, rings, grid, cos_lat[invalid_positions], rng
+        )
     else:
         print("All points were generated within the boundary on the first try!")
-        final_df = valid_points[['lat_jittered', 'lon_jittered']]
 
+    final_df = pd.DataFrame({'lat_jittered': jittered_lat, 'lon_jittered': jittered_lon})
     print(f"Fast anonymization complete for {len(final_df)} records.")
     return final_df
 
-def jitter_coordinates_with_boundary(df, lat_col, lon_col, offset_meters, boundary):
+def jitter_coordinates_with_boundary(df, lat_col, lon_col, offset_meters, rings, grid, cos_lat, rng, rejection_rounds=8):
     
-    # Applies a random offset to coordinates, ensuring they stay within the provided boundary.
-    # This is a slower, iterative method used only for points that failed the fast vectorized check.
+    # Applies a random offset to coordinates, ensuring they stay within the boundary given by rings
+    # and grid (from boundary_rings and rasterize_boundary); cos_lat is cos(lat) for each row of df,
+    # reused from the fast pass, and rng is the numpy Generator for the random draws.
+    # This is used only for points that failed the fast vectorized check. Points are first
+    # re-jittered at the full offset_meters radius for up to rejection_rounds batched rounds,
+    # keeping every draw that lands inside. Only points still outside after that get an offset
+    # capped at their distance to the boundary edge (see _bounded_jitter_kernel), so a point
+    # keeps the full radius unless it lies within offset_meters of the edge.
+    # The original points must lie inside the boundary (the caller pre-filters them).
+    # Returns the jittered (lat, lon) arrays in the same order as df.
     print(f"Applying bounded offset of up to {offset_meters} meters...")
-    earth_radius = 6378137
-    jittered_points = []
-
-    for index, row in df.iterrows():
-        original_lat = row[lat_col]
-        original_lon = row[lon_col]
-        
-        while True: # Loop until a valid point is found
-            # Generate a single random offset
-            random_distance = np.sqrt(np.random.uniform(0, 1)) * offset_meters
-            random_angle = np.random.uniform(0, 2 * np.pi)
-
-            # Calculate offsets in meters
-            lat_offset_m = random_distance * np.sin(random_angle)
-            lon_offset_m = random_distance * np.cos(random_angle)
-            
-            # Convert meter offsets to degree offsets
-            lat_offset_deg = lat_offset_m / earth_radius * (180 / np.pi)
-            lon_offset_deg = lon_offset_m / (earth_radius * np.cos(np.radians(original_lat))) * (180 / np.pi)
-
-            # Create the new point
-            new_lat = original_lat + lat_offset_deg
-            new_lon = original_lon + lon_offset_deg
-            new_point = Point(new_lon, new_lat) 
-
-            # Check if the point is inside the boundary
-            if boundary.contains(new_point):
-                jittered_points.append({'lat_jittered': new_lat, 'lon_jittered': new_lon})
-                break
+    lat = df[lat_col].to_numpy(dtype=float)
+    lon = df[lon_col].to_numpy(dtype=float)
+    jittered_lat = np.empty_like(lat)
+    jittered_lon = np.empty_like(lon)
+
+    # Retry at the full radius, one batched boundary check per round
+    pending = np.arange(len(df))
+    for _ in range(rejection_rounds):
+        if pending.size == 0:
+            break
+        candidate_lat = np.empty(pending.size)
+        candidate_lon = np.empty(pending.size)
+        _jitter_ufunc(
+            lat[pending],
+            lon[pending],
+            cos_lat[pending],
+            rng.random(pending.size),
+            rng.random(pending.size),
+            offset_meters,
+            candidate_lat,
+            candidate_lon
+        )
+        inside = boundary_mask(candidate_lon, candidate_lat, *grid, *rings)
+        jittered_lat[pending[inside]] = candidate_lat[inside]
+        jittered_lon[pending[inside]] = candidate_lon[inside]
+        pending = pending[~inside]
+
+    if pending.size > 0:
+        print(f"Capping the offset of {pending.size} points close to the boundary edge...")
+        capped_lat = np.empty(pending.size)
+        capped_lon = np.empty(pending.size)
+        _bounded_jitter_kernel(
+            lat[pending],
+            lon[pending],
+            cos_lat[pending],
+            rng.random(pending.size),
+            rng.random(pending.size),
+            offset_meters,
+            *rings,
+            capped_lat,
+            capped_lon
+        )
+        jittered_lat[pending] = capped_lat
+        jittered_lon[pending] = capped_lon
     
-    print(f"Anonymization complete for {len(jittered_points)} records.")
-    return pd.DataFrame(jittered_points)
+    print(f"Anonymization complete for {len(df)} records.")
+    return jittered_lat, jittered_lon
 
 
-def create_continental_us_boundary_with_margin(shapefile_path, buffer_meters=5000):
+def create_continental_us_boundary_with_margin(shapefile_path, buffer_meters=5000, simplify_degrees=0.01, cache_dir=None):
     ###
     # Loads a US nation shapefile and returns a polygon for the continental US
     # with an optional buffer (margin) applied to the boundary.
+    # The outline is simplified (simplify_degrees, ~1km at mid-latitudes) before buffering,
+    # and the buffered result is simplified again with the same tolerance because the round
+    # buffer joins add back more vertices than the first pass removed. Each pass can move the
+    # edge by up to simplify_degrees, so the margin must be larger than both passes combined.
+    # If cache_dir is given, the finished polygon is saved there as WKB and loaded from it on
+    # later runs instead of rebuilding. The file name includes the margin, the tolerance and the
+    # shapefile's path, size and modification time, so changing any of them builds a new cache.
     ###
+    # Convert the margin from meters to degrees
+    earth_radius = 6378137  # Earth's radius in meters
+    buffer_degrees = buffer_meters / earth_radius * (180 / np.pi)
+    if buffer_degrees <= 2 * simplify_degrees:
+        raise ValueError(
+            f"Boundary margin of {buffer_meters}m must exceed twice the {simplify_degrees} degree simplification tolerance."
+        )
+
+    cache_path = None
+    if cache_dir:
+        shapefile_stat = os.stat(shapefile_path)
+        cache_key = f"{os.path.abspath(shapefile_path)}|{shapefile_stat.st_size}|{shapefile_stat.st_mtime_ns}|{buffer_meters}|{simplify_degrees}"
+        cache_name = f"conus_boundary_{buffer_meters}m_{hashlib.sha1(cache_key.encode()).hexdigest()[:12]}.wkb"
+        cache_path = os.path.join(cache_dir, cache_name)
+
+    if cache_path and os.path.exists(cache_path):
+        print(f"Loading cached US boundary from '{cache_path}'...")
+        with open(cache_path, 'rb') as f:
+            return shapely.from_wkb(f.read())
+
     print("Loading US boundary shapefile...")
     us_gdf = gpd.read_file(shapefile_path)
 
@@ -144,120 +389,218 @@ def create_continental_us_boundary_with_margin(shapefile_path, buffer_meters=500
     # Union all polygons in the MultiPolygon (includes Keys and other small islands)
     continental_us = all_us_parts.buffer(0)  # buffer(0) fixes invalid geometries
 
-    # Apply a buffer to the boundary (convert meters to degrees)
-    earth_radius = 6378137  # Earth's radius in meters
-    buffer_degrees = buffer_meters / earth_radius * (180 / np.pi)
+    # Drop vertices that are irrelevant at the scale of the privacy jitter
+    continental_us = continental_us.simplify(tolerance=simplify_degrees, preserve_topology=True)
+
+    # Apply a buffer to the simplified boundary, then drop the extra vertices from its round joins
     buffered_polygon = continental_us.buffer(buffer_degrees)
+    buffered_polygon = buffered_polygon.simplify(tolerance=simplify_degrees, preserve_topology=True)
+
+    if cache_path:
+        # Write to a temporary file first so a crash never leaves a truncated cache behind
+        temp_cache_path = cache_path + '.tmp'
+        try:
+            with open(temp_cache_path, 'wb') as f:
+                f.write(shapely.to_wkb(buffered_polygon))
+            os.replace(temp_cache_path, cache_path)
+        except BaseException:
+            if os.path.exists(temp_cache_path):
+                os.remove(temp_cache_path)
+            raise
 
     print(f"Boundary for continental US created with a {buffer_meters}m margin.")
     return buffered_polygon
 
+def density_overlay_image(lat, lon, bounds, image_size, radius_px):
+    
+    # Renders point density over bounds ([[south, west], [north, east]]) as an RGBA image of
+    # image_size (width, height) pixels for folium's ImageOverlay. It imitates what HeatMap draws:
+    # every point is spread over radius_px pixels, the spots build up opacity the way Leaflet.heat
+    # stacks them on its canvas, and the opacity is colored with Leaflet.heat's default gradient.
+    # Size the image close to the on-screen size of bounds so single points stay visible.
+    # Rows are evenly spaced in Web Mercator so the image lines up with the map tiles without
+    # reprojection. The image size doesn't depend on the number of points.
+    (south, west), (north, east) = bounds
+    cols, rows = image_size
+
+    def mercator_y(lat_deg):
+        return np.log(np.tan(np.pi / 4 + np.radians(lat_deg) / 2))
+
+    counts, _, _ = np.histogram2d(
+        mercator_y(lat), lon,
+        bins=[rows, cols],
+        range=[[mercator_y(south), mercator_y(north)], [west, east]]
+    )
+    counts = counts[::-1] # Image rows run north to south
+
+    # Spread each point with a Gaussian spot that peaks at 1, one axis at a time
+    offsets = np.arange(-radius_px, radius_px + 1)
+    kernel = np.exp(-0.5 * (offsets / (radius_px / 3)) ** 2)
+    padded = np.pad(counts, radius_px)
+    spread = sum(weight * padded[i:i + rows, :] for i, weight in enumerate(kernel))
+    spread = sum(weight * spread[:, i:i + cols] for i, weight in enumerate(kernel))
+
+    # Overlapping translucent spots combine to 1 - (1 - a1)(1 - a2)..., approximately 1 - exp(-sum).
+    # Scaled so a lone point is nearly opaque at its center, like a HeatMap point at the default max of 1
+    opacity = 1 - np.exp(-3 * spread)
+
+    # Leaflet.heat's default gradient: blue up to 0.4, then cyan, lime, yellow and red at 1
+    stops = [0, 0.4, 0.6, 0.7, 0.8, 1]
+    image = np.zeros((rows, cols, 4), dtype=np.uint8)
+    image[..., 0] = np.interp(opacity, stops, [0, 0, 0, 0, 255, 255])
+    image[..., 1] = np.interp(opacity, stops, [0, 0, 255, 255, 255, 0])
+    image[..., 2] = np.interp(opacity, stops, [255, 255, 255, 0, 0, 0])
+    image[..., 3] = np.round(opacity * 255)
+    return image
+
 
 source_lat_col = 'lat'
 source_lon_col = 'long'
 output_dir = 'public'
 output_html_file = os.path.join(output_dir, 'anonymous_heatmap.html')
 us_shapefile = 'data/cb_2018_us_nation_5m.shp' 
+us_boundary_cache_dir = 'data' # Cached boundaries are keyed on the shapefile and boundary settings
 PRIVACY_RADIUS_METERS = 500
+HEATMAP_AGGREGATE_THRESHOLD = 100000 # Above this many points, draw a density image instead of a HeatMap
+HEATMAP_IMAGE_SIZE = (1200, 700) # width, height; about the on-screen size of map_bounds at zoom 5
+HEATMAP_IMAGE_RADIUS_PX = 13 # HeatMap's radius (8) plus blur (5)
+BOUNDARY_GRID_BOUNDS = (-125, 24, -66, 50) # west, south, east, north; points outside use the exact test
+BOUNDARY_GRID_DEGREES = 0.01
 
 
-try:
-    aws_key = os.getenv('HEATMAP_AWS_ACCESS_KEY_ID')
-    aws_secret = os.getenv('HEATMAP_AWS_SECRET_ACCESS_KEY')
-    bucket_name = os.getenv('HEATMAP_S3_BUCKET_NAME')
-    file_key = os.getenv('HEATMAP_S3_FILE_KEY')
-
-    if not all([aws_key, aws_secret, bucket_name, file_key]):
-        raise ValueError("Missing required AWS environment variables for S3 access.")
-
-    s3_client = boto3.client(
-        's3',
-        aws_access_key_id=aws_key,
-        aws_secret_access_key=aws_secret
-    )
-
-    # Create the US boundary to check against
-    us_boundary = create_continental_us_boundary_with_margin(us_shapefile, buffer_meters=5000)
-
-    # Put the single boundary polygon into a GeoDataFrame for spatial join
-    boundary_gdf = gpd.GeoDataFrame([{'geometry': us_boundary}], crs="EPSG:4326")
-
-    # Get source data from S3 and load it into dataframe
-    s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
-    csv_data = s3_object['Body'].read()
-
-    source_df = pd.read_csv(io.BytesIO(csv_data))
-    source_df.dropna(subset=[source_lat_col, source_lon_col], inplace=True)
-
-    print(f"Loaded {len(source_df)} total records with coordinates.")
-
-    # Keep only points already inside the US boundary
-    print("Pre-filtering source data to find points within the continental US...")
-    source_gdf = gpd.GeoDataFrame(
-        source_df,
-        geometry=gpd.points_from_xy(source_df[source_lon_col], source_df[source_lat_col]),
-        crs="EPSG:4326"
-    )
-
-    # Use a fast spatial join to find members inside the boundary
-    continental_us_members = gpd.sjoin(source_gdf, boundary_gdf, how="inner", predicate="within")
+def main():
     
-    original_count = len(source_df)
-    filtered_count = len(continental_us_members)
-    discarded_count = original_count - filtered_count
-
-    print(f"Kept {filtered_count} records within the continental US boundary.")
-    if discarded_count > 0:
-        print(f"Discarded {discarded_count} records located outside the boundary (e.g., AK, HI, PR, or data errors).")
-
-    # Anonymize ONLY pre-filtered data
-    if filtered_count > 0:
-        anonymized_df = fast_jitter_with_boundary(
-            continental_us_members.drop(columns=['index_right']), # Drop column added by sjoin
-            source_lat_col,
-            source_lon_col,
-            PRIVACY_RADIUS_METERS,
-            us_boundary
+    # Downloads the source CSV from S3, anonymizes the points and writes the heatmap HTML.
+    # The S3, CSV and map libraries are imported here so importing this module stays cheap.
+    import boto3
+    import folium
+    from folium.plugins import HeatMap
+    import pyarrow.csv as pa_csv
+
+    try:
+        aws_key = os.getenv('HEATMAP_AWS_ACCESS_KEY_ID')
+        aws_secret = os.getenv('HEATMAP_AWS_SECRET_ACCESS_KEY')
+        bucket_name = os.getenv('HEATMAP_S3_BUCKET_NAME')
+        file_key = os.getenv('HEATMAP_S3_FILE_KEY')
+
+        if not all([aws_key, aws_secret, bucket_name, file_key]):
+            raise ValueError("Missing required AWS environment variables for S3 access.")
+
+        s3_client = boto3.client(
+            's3',
+            aws_access_key_id=aws_key,
+            aws_secret_access_key=aws_secret
         )
 
-        # Create heatmap
-        map_center = [39.82, -98.57]
-        map_bounds = [[24, -125], [50, -66]] # Approx. bounds for continental US
-
-        m = folium.Map(
-            location=map_center, 
-            zoom_start=5, 
-            tiles='CartoDB positron', 
-            max_bounds=map_bounds, 
-            min_zoom=4,
-            zoom_delta=0.25,
-            zoom_snap=0.25
+        # Create the US boundary to check against
+        us_boundary = create_continental_us_boundary_with_margin(
+            us_shapefile, buffer_meters=5000, cache_dir=us_boundary_cache_dir
         )
-        m.fit_bounds(map_bounds)
-        heatmap_data = anonymized_df[['lat_jittered', 'lon_jittered']].values.tolist()
-        HeatMap(heatmap_data, radius=8, blur=5).add_to(m)
-
-        # Add a simple color legend to the map
-        legend_html = '''
-            <div style="position: fixed; 
-            bottom: 50px; left: 50px; width: 150px; height: 90px; 
-            border:2px solid grey; z-index:9999; font-size:14px;
-            background-color:white;
-            ">&nbsp; <b>Density</b> <br>
-            &nbsp; High &nbsp; <i class="fa fa-square" style="color:red"></i><br>
-            &nbsp; Medium &nbsp; <i class="fa fa-square" style="color:yellowgreen"></i><br>
-            &nbsp; Low &nbsp; <i class="fa fa-square" style="color:blue"></i>
-            </div>
-            '''
-        m.get_root().html.add_child(folium.Element(legend_html))
-
-        # Save Map
-        m.save(output_html_file)
-        print(f"Heatmap saved to '{output_html_file}'.")
-    else:
-        print("No source data points were found within the continental US. Cannot generate a heatmap.")
 
-except FileNotFoundError:
-    print(f"Error: A required file was not found. Check paths for '{csv_data}' and '{us_shapefile}'.")
-except Exception as e:
-    print(f"An unexpected error occurred: {e}")
\ No newline at end of file
+        # Flatten and rasterize the boundary once; these are reused by every containment check
+        us_boundary_rings = boundary_rings(us_boundary)
+        us_boundary_grid = rasterize_boundary(us_boundary, BOUNDARY_GRID_BOUNDS, BOUNDARY_GRID_DEGREES)
+
+        # Get source data from S3 and load it into dataframe
+        s3_object = s3_client.get_object(Bucket=bucket_name, Key=file_key)
+
+        # Parse straight from the response stream, reading only the coordinate columns
+        csv_table = pa_csv.read_csv(
+            s3_object['Body'],
+            convert_options=pa_csv.ConvertOptions(include_columns=[source_lat_col, source_lon_col])
+        )
+        source_lat = csv_table.column(source_lat_col).to_numpy().astype(float, copy=False)
+        source_lon = csv_table.column(source_lon_col).to_numpy().astype(float, copy=False)
+        has_coordinates = ~(np.isnan(source_lat) | np.isnan(source_lon))
+        original_count = int(has_coordinates.sum())
+
+        print(f"Loaded {original_count} total records with coordinates.")
+
+        # Keep only points already inside the US boundary
+        print("Pre-filtering source data to find points within the continental US...")
+        inside = has_coordinates & boundary_mask(source_lon, source_lat, *us_boundary_grid, *us_boundary_rings)
+        continental_us_members = pd.DataFrame({
+            source_lat_col: source_lat[inside],
+            source_lon_col: source_lon[inside]
+        })
+    
+        filtered_count = len(continental_us_members)
+        discarded_count = original_count - filtered_count
+
+        print(f"Kept {filtered_count} records within the continental US boundary.")
+        if discarded_count > 0:
+            print(f"Discarded {discarded_count} records located outside the boundary (e.g., AK, HI, PR, or data errors).")
+
+        # Anonymize ONLY pre-filtered data
+        if filtered_count > 0:
+            anonymized_df = fast_jitter_with_boundary(
+                continental_us_members,
+                source_lat_col,
+                source_lon_col,
+                PRIVACY_RADIUS_METERS,
+                us_boundary_rings,
+                us_boundary_grid
+            )
+
+            # Create heatmap
+            map_center = [39.82, -98.57]
+            map_bounds = [[24, -125], [50, -66]] # Approx. bounds for continental US
+
+            m = folium.Map(
+                location=map_center, 
+                zoom_start=5, 
+                tiles='CartoDB positron', 
+                max_bounds=map_bounds, 
+                min_zoom=4,
+                zoom_delta=0.25,
+                zoom_snap=0.25
+            )
+            m.fit_bounds(map_bounds)
+            heatmap_data = anonymized_df[['lat_jittered', 'lon_jittered']].to_numpy()
+            if len(heatmap_data) > HEATMAP_AGGREGATE_THRESHOLD:
+                print(f"Rendering {len(heatmap_data)} points to a density image...")
+                folium.raster_layers.ImageOverlay(
+                    image=density_overlay_image(
+                        heatmap_data[:, 0], heatmap_data[:, 1], map_bounds, HEATMAP_IMAGE_SIZE, HEATMAP_IMAGE_RADIUS_PX
+                    ),
+                    bounds=map_bounds
+                ).add_to(m)
+            else:
+                HeatMap(heatmap_data, radius=8, blur=5).add_to(m)
+
+            # Add a simple color legend to the map
+            legend_html = '''
+                <div style="position: fixed; 
+                bottom: 50px; left: 50px; width: 150px; height: 90px; 
+                border:2px solid grey; z-index:9999; font-size:14px;
+                background-color:white;
+                ">&nbsp; <b>Density</b> <br>
+                &nbsp; High &nbsp; <i class="fa fa-square" style="color:red"></i><br>
+                &nbsp; Medium &nbsp; <i class="fa fa-square" style="color:yellowgreen"></i><br>
+                &nbsp; Low &nbsp; <i class="fa fa-square" style="color:blue"></i>
+                </div>
+                '''
+            m.get_root().html.add_child(folium.Element(legend_html))
+
+            # Save Map to a temporary file first so a failed run never leaves a half-written page
+            temp_html_file = output_html_file + '.tmp'
+            try:
+                m.save(temp_html_file)
+                os.replace(temp_html_file, output_html_file)
+            except BaseException:
+                # Don't leave the partial file in the published directory
+                if os.path.exists(temp_html_file):
+                    os.remove(temp_html_file)
+                raise
+            print(f"Heatmap saved to '{output_html_file}'.")
+        else:
+            print("No source data points were found within the continental US. Cannot generate a heatmap.")
+
+    except FileNotFoundError:
+        print(f"Error: A required file was not found. Check paths for '{file_key}' and '{us_shapefile}'.")
+    except Exception as e:
+        print(f"An unexpected error occurred: {e}")
+
+
+if __name__ == "__main__":
+    main()